@@ -7,11 +7,35 @@
 # LOWERBOUND = 406000
 
 import os
+import sys
+import shutil
+import socket
+import traceback
+import itertools
 from abc import ABC, abstractmethod
+import asyncio
 import threading
+from concurrent.futures import ThreadPoolExecutor
+from queue import SimpleQueue
 import logging
 import time
 import requests     # use `pip install --user requests` if ModuleNotFoundError
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from urllib3.exceptions import HTTPError as Urllib3Error
+try:
+    import aiohttp  # optional; `pip install --user aiohttp` for the asyncio downloader
+except ImportError:
+    aiohttp = None
+try:
+    import httpx    # optional; `pip install --user 'httpx[http2]'` for --http2
+    import h2       # noqa: F401; httpx needs it for http2 support
+except ImportError:
+    httpx = None
+try:
+    import uvloop   # optional; `pip install --user uvloop` for a faster event loop
+except ImportError:
+    uvloop = None
 
 # Logging disabled, enable to debug
 logging.basicConfig(level = logging.DEBUG,
@@ -24,6 +48,76 @@ logging.getLogger('urllib3.connectionpool').disabled = True
 logging.disable(logging.CRITICAL)
 
 
+def cache_dns(ttl: float = 600) -> None:
+    """
+    Memoize socket.getaddrinfo for ttl seconds, so new connections to
+    the S3 host don't each resolve it again; a lookup raced by two
+    threads just resolves twice
+    """
+
+    getaddrinfo = socket.getaddrinfo
+    cache = {}
+
+    def cached_getaddrinfo(*args, **kw):
+        key = (args, tuple(sorted(kw.items())))
+        now = time.monotonic()
+        entry = cache.get(key)
+        if entry is None or entry[0] < now:
+            entry = cache[key] = (now + ttl, getaddrinfo(*args, **kw))
+        return entry[1]
+
+    socket.getaddrinfo = cached_getaddrinfo
+
+
+class MissIndex:
+    """
+    Ids in a range known to have no image, kept on disk between runs
+    so that re-scrapes can skip them; one byte per id so that marking
+    an id from many threads needs no lock
+    """
+
+    MISSING = (403, 404)    # S3 answers 403 for absent keys without list permission
+
+    def __init__(self, path: str, lowerbound: int, upperbound: int):
+        self.path = path
+        self.lowerbound = lowerbound
+        self.upperbound = upperbound
+        self._missing = bytearray(max(0, upperbound - lowerbound))     # empty range if inverted
+
+        try:
+            with open(path, 'rb') as indexFile:
+                header = indexFile.readline()
+                missing = indexFile.read()
+            lower, upper = map(int, header.split())
+            size = max(0, upper - lower)
+            if len(missing) != size:
+                raise ValueError(f'index body has {len(missing)} bytes, expected {size}')
+        except FileNotFoundError:
+            return
+        except ValueError as error:         # damaged index; start over with an empty one
+            print(f'Ignoring damaged miss index {path}: {error}', file=sys.stderr)
+            return
+        # keep whatever part of the previous run's range overlaps this one
+        start, stop = max(lower, lowerbound), min(upper, upperbound)
+        if start < stop:
+            self._missing[start - lowerbound:stop - lowerbound] = missing[start - lower:stop - lower]
+
+    def __contains__(self, image_id: int) -> bool:
+        return (self.lowerbound <= image_id < self.upperbound
+                and self._missing[image_id - self.lowerbound])
+
+    def add(self, image_id: int) -> None:
+        self._missing[image_id - self.lowerbound] = 1
+
+    def save(self) -> None:
+        # write aside and swap it in, an interrupted save never leaves a truncated index
+        tmppath = f'{self.path}.tmp'
+        with open(tmppath, 'wb') as indexFile:
+            indexFile.write(f'{self.lowerbound} {self.upperbound}\n'.encode())
+            indexFile.write(self._missing)
+        os.replace(tmppath, self.path)
+
+
 class AbstractDownloader(ABC):
     try:
         import resource # works in *nix platforms
@@ -34,17 +128,24 @@ class AbstractDownloader(ABC):
                      if resource # if resource got imported successfully
                      else 1200)  # a hardcoded value that works in Windows
 
-    # static link with placeholders for id
-    URLFMT = "https://ucanassessm.s3.ap-south-1.amazonaws.com/Latest/{server_id}/{id}/{id}.png"
+    # static link prefix; links are completed with '{id}/{id}.png'
+    URLPREFIX = "https://ucanassessm.s3.ap-south-1.amazonaws.com/Latest/{server_id}/"
     # fake app requests to server as client-side browser
     HEADER = {'user-agent':
-              'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/72.0.3626.28 Safari/537.36'}
-    CHUNKSIZE = 10000000    # byte-size for image saving
+              'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/72.0.3626.28 Safari/537.36',
+              # pngs don't compress; ask for them as is and skip the decoders
+              'accept-encoding': 'identity'}
+    CHUNKSIZE = 1 << 16     # byte-size of the copy buffer for image saving
+    MAX_WORKERS = 256       # default number of concurrent requests
+    RESERVED_FDS = 32       # descriptors kept free for stdio, dns, the interpreter etc.
+    TIMEOUT = (10, 30)      # connect and read timeouts in seconds for a request
 
     def __init__(self, server_id: int):
         self.server_id = server_id
-        self.mutex = threading.Lock()
+        self._url_prefix = self.URLPREFIX.format(server_id=server_id)
         self.numDownloads = 0
+        self.numFailures = 0
+        self.workers = self.MAX_WORKERS
 
     @abstractmethod
     def run(self):
@@ -54,52 +155,122 @@ class AbstractDownloader(ABC):
         " Entry point; calls run defined in subclasses to start download "
 
         # create directory specified if not already present; potential permission exception
-        logging.debug(f'{downloadDir = }')
+        logging.debug('downloadDir = %r', downloadDir)
         if not os.path.isdir(downloadDir):
             os.makedirs(downloadDir, exist_ok=True)
         self.downloadDir = downloadDir
 
         session = requests.Session()        # potential speedup requests by perpetual connection
         session.headers.update(self.HEADER)
+        # every link is on the same host; keep one connection alive per worker instead of
+        # dropping and re-handshaking past urllib3's default of 10 pooled connections
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.workers, pool_block=True,
+                              max_retries=Retry(total=3, backoff_factor=0.2,
+                                                status_forcelist=[502, 503, 504]))
+        session.mount('https://', adapter)
         self.trace = trace
         self.__session = session
-        self.numDownloads = 0
+        # next() on a count is atomic under the GIL, so workers never wait on a lock
+        self._counter = itertools.count(1)
+        self._failures = itertools.count(1)
+        if trace:                           # a single thread prints, output never interleaves
+            self._log_q = SimpleQueue()
+            printer = threading.Thread(target=self._printer, daemon=True)
+            printer.start()
         startTime = time.time()
 
         self.run()
 
         self.__session.close()
+        if trace:
+            self._log_q.put(None)
+            printer.join()
+        self.numDownloads = next(self._counter) - 1
+        self.numFailures = next(self._failures) - 1
         return round(time.time() - startTime, 2)
 
-    def _download(self, url: str, name: str = None, savedir: str = None) -> str:
+    def _printer(self) -> None:
+        " Target method for the printing thread; write messages until a None sentinel "
+
+        for message in iter(self._log_q.get, None):
+            sys.stdout.write(message + '\n')
+
+    def _downloaded(self, imagename: str) -> None:
+        " Count a saved image and report it if tracing "
+
+        next(self._counter)
+        if self.trace:
+            self._log_q.put(f'Downloaded {imagename}')
+
+    def _failed(self, imagepath: str, error: OSError) -> None:
+        " Count an image that could not be saved and report it; logging is disabled "
+
+        next(self._failures)
+        print(f'Could not save {imagepath}: {error}', file=sys.stderr)
+
+    def _missed(self, image_id: int) -> None:
+        " Called with an id that has no image; override to keep track of misses "
+
+    def _download(self, image_id: int, name: str = None, savedir: str = None) -> str:
         """
-        Method to check and download given link
+        Method to check and download the image for given id
         Return image path if save successful, None otherwise
         """
 
+        url = f'{self._url_prefix}{image_id}/{image_id}.png'
         try:
-            response = self.__session.get(url)
-        except:                            # if network error or cant fetch
+            response = self.__session.get(url, stream=True,   # only headers are read here
+                                          timeout=self.TIMEOUT)
+        except requests.RequestException:  # if network error or cant fetch
             return None
-        if response.status_code == requests.codes.ok:   # if image received
-            imagename = (name if name
-                         else os.path.basename(url) )
-            savedir = savedir if savedir else self.downloadDir
-            imagepath = os.path.join(savedir, imagename)
-            logging.debug(f'{savedir = }')
-            logging.debug(f'{imagename = }')
-            logging.debug(f'{imagepath = }')
 
+        partial = None                      # set once the image file is ours to remove
+        try:
+            if response.status_code != requests.codes.ok:
+                if response.status_code in MissIndex.MISSING:
+                    self._missed(image_id)
+                # most ids miss; read the short error body only so the connection goes
+                # back to the pool, closing it unread would tear the connection down
+                response.content
+                return None
+
+            imagename = name if name else f'{image_id}.png'
+            savedir = savedir if savedir else self.downloadDir
+            imagepath = f'{savedir}/{imagename}'
+            logging.debug('savedir = %r', savedir)
+            logging.debug('imagename = %r', imagename)
+            logging.debug('imagepath = %r', imagepath)
+
+            # copy straight from the urllib3 response through a fixed size buffer; splicing
+            # the socket into the file in-kernel is not possible, the links are https and
+            # the socket carries tls records that have to be decrypted in user space
+            response.raw.decode_content = True
             with open(imagepath, 'wb') as imageFile:
-                for chunk in response.iter_content(self.CHUNKSIZE):
-                    imageFile.write(chunk)
+                partial = imagepath
+                shutil.copyfileobj(response.raw, imageFile, self.CHUNKSIZE)
+        except (requests.RequestException, Urllib3Error):  # if connection broke mid-image
+            self._discard(partial)
+            return None
+        except OSError as error:           # disk full, permissions; skip just this image
+            self._failed(imagepath, error)
+            self._discard(partial)
+            return None
+        finally:
+            response.close()
 
-            with self.mutex:               # make downloads thread-safe
-                if self.trace:
-                    print(f'Downloaded {imagename}')
-                self.numDownloads += 1
+        self._downloaded(imagename)
+        return imagepath
 
-            return imagepath
+    @staticmethod
+    def _discard(imagepath: str) -> None:
+        " Remove a partially written image, if one was started "
+
+        if imagepath is None:
+            return
+        try:
+            os.remove(imagepath)
+        except OSError:                    # already gone or not removable; nothing more to do
+            pass
 
 
 class Downloader(AbstractDownloader):
@@ -110,6 +281,7 @@ class Downloader(AbstractDownloader):
 
     UPPERBOUND = 520000     # default id upperbound
     LOWERBOUND = 406000     # default id lowerbound
+    WRITERS = 4             # threads saving images fetched by the event loop
 
     def __init__(self, server_id: int, upperbound: int = None, lowerbound: int = None):
         if upperbound:
@@ -118,39 +290,153 @@ class Downloader(AbstractDownloader):
             self.LOWERBOUND = lowerbound
 
         AbstractDownloader.__init__(self, server_id)
+        self._misses = None
 
-    def __call__(self, *args, per_thread: int = 50, **kw) -> int:
+    def __call__(self, *args, workers: int = None, http2: bool = False,
+                 skip_misses: bool = False, **kw) -> int:
         " Entry point; calls the function object to start download "
 
-        # deploy threads at most the maximum number of open file descriptors
-        # permitted to the user at a time by the operating system
-        self.per_thread = max(per_thread, self.MAX_OPEN_FILE)
-        AbstractDownloader.__call__(self, *args, **kw)
+        # each worker may hold a socket and an image file open at once; deploy at most as
+        # many as the open file descriptors permitted to the user by the operating system allow
+        max_workers = (self.MAX_OPEN_FILE - self.RESERVED_FDS) // 2
+        self.workers = max(1, min(workers or self.MAX_WORKERS, max_workers))
+        self.http2 = http2 and httpx is not None    # aiohttp or threads otherwise
+        self.skip_misses = skip_misses
+        return AbstractDownloader.__call__(self, *args, **kw)
 
     def run(self) -> None:
+        if self.skip_misses:
+            self._misses = MissIndex(os.path.join(self.downloadDir, f'.misses-{self.server_id}'),
+                                     self.LOWERBOUND, self.UPPERBOUND)
+        try:
+            self._run()
+        finally:                            # keep the misses found so far, even if interrupted
+            if self._misses is not None:
+                self._misses.save()
 
-        threads = []
-        for start in range(self.LOWERBOUND, self.UPPERBOUND, self.per_thread):
-            thread = threading.Thread(target=self._thread, args=(start, start + self.per_thread))
-            threads.append(thread)
-            thread.start()
+    def _run(self) -> None:
+        if aiohttp or self.http2:           # single event loop if an async client is available
+            asyncio.run(self._arun())
+            return
 
-        for thread in threads: thread.join()
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            for _ in executor.map(self._thread, range(self.workers)):
+                pass
 
-    def _thread(self, start: int, stop: int) -> None:
+    def _thread(self, k: int) -> None:
         """
-        Target method for threading; download a given set of
-        images from start to stop
+        Target method for threading; download every workers-th link
+        starting at the k-th, interleaved with the other threads
         """
 
-        for url in self.generate_links(start, stop):
-            self._download(url)
-
-    def generate_links(self, start: int, stop: int) -> None:
-        " Convenience method for getting formatted links "
+        for image_id in self.generate_ids(self.LOWERBOUND + k, self.UPPERBOUND, self.workers):
+            self._download(image_id)
+
+    async def _arun(self) -> None:
+        " Download the whole id range concurrently on one event loop "
+
+        connect, read = self.TIMEOUT            # same limits as the requests path
+        queue = asyncio.Queue(maxsize=self.workers)
+        with ThreadPoolExecutor(max_workers=self.WRITERS) as io_pool:
+            writers = [asyncio.create_task(self._writer(queue, io_pool))
+                       for _ in range(self.WRITERS)]
+            if self.http2:
+                # http2 multiplexes the requests over a few connections; httpx falls
+                # back to http/1.1 keep-alive if the server does not negotiate it
+                limits = httpx.Limits(max_connections=self.workers,
+                                      max_keepalive_connections=self.workers)
+                client = httpx.AsyncClient(http2=True, limits=limits, headers=self.HEADER,
+                                           timeout=httpx.Timeout(read, connect=connect))
+                get, errors = self._get_httpx, (httpx.HTTPError,)
+            else:
+                # one keep-alive connection per worker to the single S3 host, so requests
+                # go back-to-back on open connections instead of paying TCP+TLS setup each
+                connector = aiohttp.TCPConnector(limit=self.workers, limit_per_host=self.workers,
+                                                 keepalive_timeout=75,
+                                                 use_dns_cache=True, ttl_dns_cache=3600,
+                                                 force_close=False, enable_cleanup_closed=True)
+                timeout = aiohttp.ClientTimeout(sock_connect=connect, sock_read=read)
+                client = aiohttp.ClientSession(connector=connector, headers=self.HEADER,
+                                               timeout=timeout)
+                get, errors = self._get_aiohttp, (aiohttp.ClientError, asyncio.TimeoutError)
+
+            async with client:             # a fixed set of workers bounds the in-flight requests
+                await asyncio.gather(*(self._aworker(k, client, get, errors, queue)
+                                       for k in range(self.workers)))
+
+            for _ in writers:                   # one sentinel per writer
+                await queue.put(None)
+            await asyncio.gather(*writers)
+
+    async def _aworker(self, k: int, client, get, errors: tuple, queue: asyncio.Queue) -> None:
+        " Coroutine counterpart of _thread; fetch every workers-th link starting at the k-th "
+
+        for image_id in self.generate_ids(self.LOWERBOUND + k, self.UPPERBOUND, self.workers):
+            await self._fetch(client, get, errors, queue, image_id)
+
+    async def _fetch(self, client, get, errors: tuple,
+                     queue: asyncio.Queue, image_id: int) -> bool:
+        """
+        Coroutine counterpart of _download; queue the image for saving
+        Return True if image received, False otherwise
+        """
 
-        for i in range(start, stop):
-            yield self.URLFMT.format(server_id=self.server_id, id=i)
+        try:
+            status, image = await get(client, f'{self._url_prefix}{image_id}/{image_id}.png')
+        except errors:                          # network error or cant fetch
+            return False
+        if status != 200:
+            if status in MissIndex.MISSING:
+                self._missed(image_id)
+            return False
+
+        await queue.put((f'{image_id}.png', image))
+        return True
+
+    @staticmethod
+    async def _get_aiohttp(session, url: str) -> tuple:
+        " Return the status and body for url using aiohttp "
+
+        async with session.get(url) as response:
+            # misses are read too; drains the error body to keep the connection alive
+            return response.status, await response.read()
+
+    @staticmethod
+    async def _get_httpx(client, url: str) -> tuple:
+        " Return the status and body for url using httpx "
+
+        response = await client.get(url)
+        return response.status_code, response.content
+
+    def _missed(self, image_id: int) -> None:
+        if self._misses is not None:
+            self._misses.add(image_id)
+
+    async def _writer(self, queue: asyncio.Queue, io_pool: ThreadPoolExecutor) -> None:
+        " Save queued images on the io pool until a None sentinel is received "
+
+        loop = asyncio.get_running_loop()
+        while (item := await queue.get()) is not None:
+            imagename, image = item
+            imagepath = f'{self.downloadDir}/{imagename}'
+            logging.debug('imagepath = %r', imagepath)
+            try:                                # file i/o blocks, keep it off the loop thread
+                await loop.run_in_executor(io_pool, self._save, imagepath, image)
+            except OSError as error:
+                self._failed(imagepath, error)
+                continue
+            self._downloaded(imagename)
+
+    @staticmethod
+    def _save(imagepath: str, image: bytes) -> None:
+        with open(imagepath, 'wb') as imageFile:
+            imageFile.write(image)
+
+    def generate_ids(self, start: int, stop: int, step: int = 1) -> None:
+        " Convenience method for getting the ids to try "
+
+        misses = self._misses or ()         # ids known to be missing on earlier runs
+        return (i for i in range(start, stop, step) if i not in misses)
 
 
 class Watcher(AbstractDownloader):
@@ -160,29 +446,49 @@ class Watcher(AbstractDownloader):
     def __init__(self, server_id: str, watch_ids: list):
         self.watch_ids = watch_ids
         AbstractDownloader.__init__(self, server_id)
+        self.workers = len(watch_ids)       # one request in flight per id at a time
+        self._ensured_dirs = set()          # save directories already created
 
     def run(self):
         loop_id = 1
-        logging.debug(f'{self.watch_ids = }')
+        logging.debug('self.watch_ids = %r', self.watch_ids)
+        # the same threads serve every loop instead of new ones every WAIT_TIME
+        pool = ThreadPoolExecutor(max_workers=self.workers)
+        pending = {}                        # last download submitted for each id
         while True:
             try:
                 for watch_id in self.watch_ids:
-                    thread = threading.Thread(target=self._thread, args=(watch_id, loop_id))
-                    thread.daemon = True
-                    thread.start()
+                    # a stalled download still holds its worker; don't queue more behind it
+                    if watch_id in pending and not pending[watch_id].done():
+                        continue
+                    future = pool.submit(self._thread, watch_id, loop_id)
+                    future.add_done_callback(self._log_failure)
+                    pending[watch_id] = future
                 time.sleep(self.WAIT_TIME)
                 loop_id += 1
             except KeyboardInterrupt:
                 break
+        pool.shutdown(wait=False, cancel_futures=True)
+
+    @staticmethod
+    def _log_failure(future) -> None:
+        " Done callback for submitted downloads; print the exception _thread raised, if any "
+
+        if future.cancelled():
+            return
+        error = future.exception()
+        if error is not None:               # logging is disabled, report on stderr
+            traceback.print_exception(type(error), error, error.__traceback__)
 
     def _thread(self, watch_id: int, loop_id: int) -> None:
-        logging.debug(f'{self.downloadDir = }')
-        savedir = os.path.join(self.downloadDir, str(watch_id))
-        if not os.path.isdir(savedir):
+        logging.debug('self.downloadDir = %r', self.downloadDir)
+        savedir = f'{self.downloadDir}/{watch_id}'
+        # stat only on the first loop; set.add is atomic and makedirs tolerates a racing thread
+        if savedir not in self._ensured_dirs:
             os.makedirs(savedir, exist_ok=True)
+            self._ensured_dirs.add(savedir)
         imagename = f'{watch_id}_{loop_id}.png'
-        self._download(self.URLFMT.format(server_id=self.server_id, id=watch_id),
-                       imagename, savedir)
+        self._download(watch_id, imagename, savedir)
 
 
 if __name__ == '__main__':
@@ -195,19 +501,38 @@ if __name__ == '__main__':
     parser.add_argument('-u', '--upper',  default=None,  type=int, help='Upper bound of numeric url to try')
     parser.add_argument('-l', '--lower',  default=None,  type=int, help='Lower bound of numeric url to try')
     parser.add_argument('-s', '--silent', default=False, action='store_true', help='Disable download messages')
-    parser.add_argument('--per_thread',   default=20,    type=int, help='Number of images per thread')
+    parser.add_argument('-w', '--workers', '--per_thread', default=None, type=int,
+                        help='Number of concurrent downloads')
+    parser.add_argument('--http2', default=False, action='store_true',
+                        help='Use an http2 client, needs httpx[http2] installed')
+    parser.add_argument('--skip-misses', default=False, action='store_true',
+                        help='Skip ids found missing on earlier runs for the same server id')
 
     args = parser.parse_args()
-    logging.info(f'{args = }')
+
+    if args.http2 and httpx is None:        # logging is disabled, tell the user directly
+        print('httpx[http2] is not installed, --http2 ignored', file=sys.stderr)
+
+    cache_dns()                             # for connections opened by requests and httpx
+
+    if uvloop:                              # libuv based loop for the async downloader
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    elif sys.platform == 'win32':
+        asyncio.set_event_loop_policy(asyncio.WindowsSelectorEventLoopPolicy())
+    logging.info('args = %r', args)
 
     if args.watch:
         downloader = Watcher(args.server_id, args.watch)
         time_taken = downloader(args.directory, not args.silent)
     else:
         downloader = Downloader(args.server_id, args.upper, args.lower)
-        time_taken = downloader(args.directory, not args.silent, per_thread=args.per_thread)
+        time_taken = downloader(args.directory, not args.silent,
+                                workers=args.workers, http2=args.http2,
+                                skip_misses=args.skip_misses)
 
     print('\n\n' + ' Stats '.center(25, '*') + '\n')
     print('Downloaded %d images in "%s", in %d seconds.' % (
         downloader.numDownloads, os.path.abspath(args.directory), time_taken
     ))
+    if downloader.numFailures:
+        print('Could not save %d images.' % downloader.numFailures)